@@ -8,12 +8,25 @@ Created on Fri Oct 27 12:21:02 2017
 Fill algorithm modeled on:
 http://pillow-cn.readthedocs.io/zh_CN/latest/_modules/PIL/ImageDraw.html
 """
+import sys
+import tempfile
+import time
+
 import numpy as np
 import cv2
 
+try:
+    import resource
+except ImportError:#Not available on Windows.
+    resource = None
+
 #Public variable for mouse clicks.
 click_coordinates = (0, 0) #I really didn't want to do this but see no other way.
 
+#Bytes per filled pixel for the boundary list in bgra_fill_zone, measured
+#with tracemalloc.
+FLOOD_FILL_BYTES = 55
+
 
 def get_image_from_user():
     """ This function gets an image from a user inputted file name.
@@ -37,16 +50,27 @@ def get_image_from_user():
 
 
 
-def grayscale(image):
+def grayscale(image, band=0, out=None):
     """ This function returns a 3 channel grayscale version of the input image.
 
     Args:
         An image that will be made grayscale.
+        Optionally, a number of rows to work through at a time and an image
+        to write the result into.
 
     Returns:
         A 3 channel grayscale image.
     """
     
+    #Work through a band of rows at a time to bound memory.
+    if band or out is not None:
+        band = band or image.shape[0]
+        if out is None:
+            out = np.zeros(image.shape, np.uint8)
+        for start in range(0, image.shape[0], band):
+            out[start:start+band] = grayscale(image[start:start+band])
+        return out
+    
     img_cpy = image.copy()
     
     for r in range(img_cpy.shape[0]):
@@ -96,6 +120,351 @@ def build_mask(image, threshold_tuple):
     return mask
 
 
+def timed(function, *args):
+    """ This function runs another function and measures how long it took.
+
+    Args:
+        A function to run, followed by the arguments to pass into it.
+
+    Returns:
+        A tuple of the function's output and the seconds it took to run.
+    """
+    start = time.perf_counter()
+    output = function(*args)
+    
+    return (output, time.perf_counter() - start)
+
+
+def allocate(shape, on_disk, dtype=np.uint8):
+    """ This function makes an empty image, in memory or on disk.
+    
+    An image on disk is a memmap of a temporary file, so it only takes up
+    memory for the pages in use.
+
+    Args:
+        The shape of the image, a Bool of whether to keep it on disk, and
+        optionally its data type.
+
+    Returns:
+        An empty image, 8 bit unless another type is asked for.
+    """
+    if on_disk:
+        return np.memmap(tempfile.TemporaryFile(), dtype, "w+", shape=shape)
+    
+    return np.zeros(shape, dtype)
+
+
+def stash(array, on_disk):
+    """ This function moves an array onto disk if asked to.
+
+    Args:
+        An array and a Bool of whether to keep it on disk.
+
+    Returns:
+        The array, or a copy of it on disk.
+    """
+    if not on_disk or array is None:
+        return array
+    
+    stored = allocate(array.shape, True, array.dtype)
+    stored[:] = array
+    
+    return stored
+
+
+def array_bytes(*arrays):
+    """ This function adds up the memory held by some arrays.
+    
+    Arrays that are None or kept on disk are not counted.
+
+    Args:
+        Any number of arrays.
+
+    Returns:
+        The bytes of memory they hold.
+    """
+    total = 0
+    for array in arrays:
+        if array is not None and not isinstance(array, np.memmap):
+            total += array.nbytes
+    
+    return total
+
+
+def record(measured, stage, allocated):
+    """ This function records the bytes a stage allocated.
+    
+    Only the largest run of each stage is kept.
+
+    Args:
+        A dict of bytes per stage or None to skip recording, the name of the
+        stage, and the bytes it allocated.
+
+    Returns:
+        Nothing.
+    """
+    if measured is not None:
+        measured[stage] = max(measured.get(stage, 0), allocated)
+
+
+def peak_memory():
+    """ This function gets the most memory this process has used so far.
+
+    Args:
+        None
+
+    Returns:
+        The peak resident memory in bytes, or None where the resource module
+        isn't available.
+    """
+    if resource is None:
+        return None
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":#Already in bytes on Mac, kilobytes elsewhere.
+        return peak
+    
+    return peak*1024
+
+
+def plan_memory(shape, budget, use_segments, segment_scale):
+    """ This function projects how much memory each stage of a run will need.
+    
+    Bytes per pixel for each stage follow the copies it makes.  A flood fill
+    is planned as covering the whole image, since any click might.  If the
+    projected peak is over budget, the grayscale image, segment labels and
+    feather distances are moved to disk, segmentation is shrunk or turned
+    off if it is what doesn't fit, and the per pixel stages (grayscale,
+    overlay and finalize) are planned in bands of rows that fit in what is
+    left.  The other stages need the whole image, so they can't be banded.
+
+    Args:
+        The shape of the image, a memory budget in bytes or None for no
+        limit, a Bool of segmentation on or off, and the segmentation scale.
+
+    Returns:
+        A tuple of a dict of projected bytes per stage, the projected peak in
+        bytes, the rows per band or 0 for untiled, a Bool of whether to keep
+        grayscale, labels and distances on disk, then the segmentation Bool
+        and scale to use.
+    """
+    (rows, cols) = (shape[0], shape[1])
+    pixels = rows*cols
+    
+    def project(band, on_disk, use_segments, segment_scale):
+        #Bytes per pixel held for the whole run: color, mask and its 
+        #coverage, plus grayscale, labels and distances if not on disk.
+        held = 3 + 4 + 1
+        if not on_disk:
+            held += 3 + 4
+            if use_segments:
+                held += 4
+        
+        #Bytes per pixel while each stage runs, as (whole image, per band).
+        #Segmenting and merging run at the reduced scale, then labels are
+        #grown back to full size.  A handler copies the mask, and a fill
+        #copies it three more times on top of its boundary list.
+        stages = {"grayscale": (0, 3),
+                  "mask": (4, 0),
+                  "segment": (0, 0),
+                  "distance": (14, 0),
+                  "handler": (4 + 3*4 + FLOOD_FILL_BYTES, 0),
+                  "overlay": (3, 7),
+                  "finalize": (3, 28)}
+        if use_segments:
+            stages["segment"] = (32*segment_scale**2 + 4, 0)
+        
+        band_pixels = band*cols if band else pixels
+        usage = dict((name, int(whole*pixels + per_band*band_pixels))
+                     for (name, (whole, per_band)) in stages.items())
+        
+        return (usage, held*pixels + max(usage.values()), stages, held*pixels)
+    
+    #Try the whole image at once first.
+    (band, on_disk) = (0, False)
+    (usage, peak, stages, held) = project(band, on_disk, use_segments, segment_scale)
+    
+    if budget is not None and peak > budget:
+        #Move what we can to disk.
+        on_disk = True
+        (usage, peak, stages, held) = project(rows, on_disk, use_segments, segment_scale)
+        
+        #The largest whole image stage we can't shrink sets the floor on our
+        #peak, so nothing else needs to fit under less than that.
+        largest = max(whole for (name, (whole, per_band)) in stages.items() if name != "segment")
+        ceiling = max(budget, held + largest*pixels)
+        
+        #Shrink segmentation to fit what is left, or skip it if even a small
+        #one won't.
+        if use_segments:
+            room = (ceiling - held)/float(pixels)
+            if 32*segment_scale**2 + 4 > room:
+                if room > 4 + 32*0.1**2:
+                    segment_scale = ((room - 4)/32.)**0.5
+                else:
+                    use_segments = False
+            (usage, peak, stages, held) = project(rows, on_disk, use_segments, segment_scale)
+        
+        #Band each per pixel stage with the room left after its whole image
+        #part.
+        band = rows
+        for (whole, per_band) in stages.values():
+            if per_band:
+                band = min(band, int((ceiling - held - whole*pixels)//(per_band*cols)))
+        band = max(band, 16) #Any smaller and the bands cost more than they save.
+        band = min(band, rows)
+        
+        (usage, peak, stages, held) = project(band, on_disk, use_segments, segment_scale)
+    
+    return (usage, peak, band, on_disk, use_segments, segment_scale)
+
+
+def segment(image, step, scale, tolerance=None):
+    """ This function splits an image into superpixel regions.
+    
+    Seeds are laid on a grid every step pixels and nudged to the lowest
+    gradient in their 3x3 neighborhood, SLIC style.  The seeds are then grown
+    with a watershed so every pixel belongs to exactly one region.  Large
+    images can be shrunk by scale first to keep this cheap, and similar
+    regions are merged while the label map is still small.
+
+    Args:
+        A color image, the spacing in pixels between seeds, a scale factor
+        from 0 to 1 applied before segmenting, and optionally a tolerance
+        for merge_segments.
+
+    Returns:
+        A label map the size of the image with one integer id per region.
+    """
+    (rows, cols) = (image.shape[0], image.shape[1])
+    
+    if scale <= 0:
+        raise ValueError("Segment scale must be greater than 0.")
+    
+    #Shrink the image so large inputs stay fast.
+    small = image
+    if scale < 1.:
+        size = (max(1, int(round(cols*scale))), max(1, int(round(rows*scale))))
+        small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    (s_rows, s_cols) = (small.shape[0], small.shape[1])
+    
+    #Gradient magnitude of the image, used to move the seeds off of edges.
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    
+    #Lay the seeds on a grid.
+    step = max(int(step*min(scale, 1.)), 2)
+    seed_r = np.arange(step//2, s_rows, step)
+    seed_c = np.arange(step//2, s_cols, step)
+    
+    #A step wider than the image still gets one seed, in the middle.
+    if seed_r.size == 0:
+        seed_r = np.array([s_rows//2])
+    if seed_c.size == 0:
+        seed_c = np.array([s_cols//2])
+    (seed_r, seed_c) = np.meshgrid(seed_r, seed_c, indexing="ij")
+    (seed_r, seed_c) = (seed_r.ravel(), seed_c.ravel())
+    
+    #Nudge each seed to the lowest gradient in its neighborhood.
+    best = gradient[seed_r, seed_c].astype(np.int32)
+    (best_r, best_c) = (seed_r.copy(), seed_c.copy())
+    for (i, j) in ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)):
+        r = np.clip(seed_r + i, 0, s_rows - 1)
+        c = np.clip(seed_c + j, 0, s_cols - 1)
+        value = gradient[r, c].astype(np.int32)
+        lower = value < best
+        best[lower] = value[lower]
+        best_r[lower] = r[lower]
+        best_c[lower] = c[lower]
+    
+    #Grow the seeds into regions.
+    markers = np.zeros((s_rows, s_cols), np.int32)
+    markers[best_r, best_c] = np.arange(1, best_r.size + 1)
+    cv2.watershed(small, markers)
+    
+    #The watershed leaves -1 on region edges, hand them to a neighbor.
+    labels = markers.astype(np.float32)
+    labels[labels < 0] = 0
+    for _ in range(max(s_rows, s_cols)):#Any gap is gone by now.
+        empty = labels == 0
+        if not empty.any():
+            break
+        grown = cv2.dilate(labels, np.ones((3, 3), np.uint8))
+        labels[empty] = grown[empty]
+    labels[labels == 0] = 1 #Just in case nothing was there to grow from.
+    labels = labels.astype(np.int32)
+    
+    #Merge before growing back, it's much cheaper at the small size.
+    if tolerance is not None:
+        labels = merge_segments(small, labels, tolerance)
+    
+    #Bring the labels back to full size.
+    if (s_rows, s_cols) != (rows, cols):
+        labels = cv2.resize(labels, (cols, rows), interpolation=cv2.INTER_NEAREST)
+    
+    return labels
+
+
+def merge_segments(image, labels, tolerance):
+    """ This function merges touching regions that have similar colors.
+    
+    The mean color of every region is taken, then any two touching regions
+    whose means are within tolerance of each other become one region.
+
+    Args:
+        A color image, its label map, and the largest color distance that
+        still counts as similar.
+
+    Returns:
+        A new label map with the similar regions merged.
+    """
+    count = labels.max() + 1
+    flat = labels.ravel()
+    
+    #Mean color of every region.
+    sizes = np.maximum(np.bincount(flat, minlength=count), 1)
+    means = np.zeros((count, 3))
+    for channel in (0, 1, 2):
+        channel_sum = np.bincount(flat, image[:,:,channel].ravel(), minlength=count)
+        means[:,channel] = channel_sum/sizes
+    
+    #Every pair of regions that touch, vertically or horizontally.  Only
+    #pixels on a region's edge are gathered, to keep this small.
+    (up, down) = (labels[:-1,:], labels[1:,:])
+    (left, right) = (labels[:,:-1], labels[:,1:])
+    edge_v = up != down
+    edge_h = left != right
+    first = np.concatenate((up[edge_v], left[edge_h])).astype(np.int64)
+    second = np.concatenate((down[edge_v], right[edge_h])).astype(np.int64)
+    
+    #Drop repeats, with each pair packed into one number so it sorts fast.
+    keys = np.unique(np.minimum(first, second)*count + np.maximum(first, second))
+    pairs = np.stack((keys//count, keys%count), axis=1)
+    
+    #Keep only the pairs that look alike.
+    distance = np.linalg.norm(means[pairs[:,0]] - means[pairs[:,1]], axis=1)
+    pairs = pairs[distance <= tolerance]
+    
+    #Union the similar pairs together.
+    parent = np.arange(count)
+    
+    def root(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+    
+    for (a, b) in pairs:
+        (a, b) = (root(a), root(b))
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+            
+    for label in range(count):
+        parent[label] = root(label)
+    
+    return parent.astype(np.int32)[labels]
+
+
 def modify_threshold(threshold_tuple, index, value):
     """ This function changes the thresholds in a min, max tuple, keeping rules.
     
@@ -308,17 +677,54 @@ def fill_mask(mask, coordinates):
     return filled_mask
 
 
-def overlay_mask(bg_tuple, bg_index):
+def fill_segment(mask, labels, coordinates):
+    """ This function fills the whole segment under a click.
+    
+    If the pixel clicked is a fill mask, then it empties the segment.
+    Otherwise it fills the segment.  Borders inside the segment are kept.
+
+    Args:
+        A mask of the border, a label map of segments, and the coordinates
+        of the click.
+
+    Returns:
+        The mask of the border with the segment filled or emptied.
+    """
+    (x, y) = coordinates
+    filled_mask = mask.copy()
+    
+    #Every non border pixel in the clicked segment.
+    zone = (labels == labels[x][y]) & (mask[:,:,1] != 255)
+    
+    if mask[x][y][1] != 255 and mask[x][y][2] == 255:
+        filled_mask[zone] = (0, 0, 0, 0)
+    else:
+        filled_mask[zone] = (0, 0, 255, 100)
+    
+    return filled_mask
+
+
+def overlay_mask(bg_tuple, bg_index, band=0):
     """ This function overlays a mask on top of the background image.
     
     Args:
         An image tuple with the background options, then a border image.  
         Then a 0 or 1 to specify our background image.
+        Optionally, a number of rows to work through at a time.
 
     Returns:
         The border mask overlayed on whichever is specified as the background.
     """
     
+    #Work through a band of rows at a time to bound memory.
+    if band:
+        mask = bg_tuple[2]
+        result = np.zeros((mask.shape[0], mask.shape[1], 3), np.uint8)
+        for start in range(0, mask.shape[0], band):
+            band_tuple = tuple(image[start:start+band] for image in bg_tuple)
+            result[start:start+band] = overlay_mask(band_tuple, bg_index)
+        return result
+    
     background = bg_tuple[bg_index].copy()
     mask = bg_tuple[2].copy()
     
@@ -343,23 +749,101 @@ def overlay_mask(bg_tuple, bg_index):
     return result
 
 
-def finalize(image_tuple, bg_index, cover_index):
+def mask_distance(mask):
+    """ This function measures how far each pixel is from the fill's edge.
+    
+    Pixels in the red fill get a positive distance and the rest get a
+    negative one.  Border lines are left out, so only fill edges get
+    feathered.  This only needs to be redone when the fill changes.
+
+    Args:
+        A mask of the border.
+
+    Returns:
+        A float array of signed distances to the edge of the fill.
+    """
+    inside = (mask[:,:,2] == 255).astype(np.uint8)
+    
+    #Exact distance to the edge from both sides of it, in real pixels.
+    dist_in = cv2.distanceTransform(inside, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    dist_out = cv2.distanceTransform(1 - inside, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    
+    return dist_in - dist_out
+
+
+def feather_blend(foreground, background, distance, radius):
+    """ This function blends the foreground over the background near edges.
+    
+    The alpha ramps over radius pixels on both sides of the mask's edge and
+    is kept in 8 bit fixed point.  Each pixel is independent, so matching
+    slices of the inputs can be blended one tile at a time.
+
+    Args:
+        A foreground image, a background image, the signed distances from
+        mask_distance, and the feather radius in pixels.
+
+    Returns:
+        The blended image.
+    """
+    #Alpha from 0 to 256, where 256 is all foreground.
+    alpha = np.rint(128. + np.clip(distance, -radius, radius)*(128./radius))
+    alpha = alpha.astype(np.uint16)[:,:,np.newaxis]
+    
+    #Weighted sum, rounded back down to 8 bits.
+    blend = foreground.astype(np.uint16)*alpha
+    blend += background.astype(np.uint16)*(256 - alpha)
+    blend += 128
+    
+    return (blend >> 8).astype(np.uint8)
+
+
+def finalize(image_tuple, bg_index, cover_index, feather=0, distance=None, band=0):
     """ This function fills within the borders of the mask.
     
     If the pixel clicked is a fill mask, then it empties the filled zone.
     If the pixel clicked is an empty mask, then it fills the empy zone.
 
+    If a feather radius is given, the edge of the mask is blended instead.
+
     Args:
         An image tuple with the image options, then a border image.  
         Then an index of our background followed by an index of our foreground.
+        A feather radius in pixels, 0 for a hard edge.
+        The signed distances from mask_distance, found here if not given.
+        Optionally, a number of rows to work through at a time.
 
     Returns:
         The mask applied to our our images with a top and bottom.
     """
+    #Work through a band of rows at a time to bound memory.
+    if band:
+        mask = image_tuple[2]
+        if feather > 0 and distance is None:
+            distance = mask_distance(mask)
+        result = np.zeros((mask.shape[0], mask.shape[1], 3), np.uint8)
+        for start in range(0, mask.shape[0], band):
+            band_tuple = tuple(image[start:start+band] for image in image_tuple)
+            band_distance = None
+            if distance is not None:
+                band_distance = distance[start:start+band]
+            result[start:start+band] = finalize(band_tuple, bg_index, cover_index, feather, band_distance)
+        return result
+    
     #Get the background and foreground images.
     background = image_tuple[bg_index].copy()
     foreground = image_tuple[cover_index].copy()
     
+    #Feather the edge of the fill rather than applying the mask absolutely.
+    if feather > 0:
+        if distance is None:
+            distance = mask_distance(image_tuple[2])
+        result = feather_blend(foreground, background, distance, feather)
+        
+        #Border lines stay hard.
+        border = image_tuple[2][:,:,1] == 255
+        result[border] = foreground[border]
+        return result
+    
     #Prepare our result
     result = np.zeros((background.shape[0], background.shape[1], 3), np.uint8) #Empty 3 channel array.
     
@@ -376,7 +860,7 @@ def finalize(image_tuple, bg_index, cover_index):
     return result
   
               
-def publish(image_tuple, bg_index, cover_index):
+def publish(image_tuple, bg_index, cover_index, feather=0, distance=None, band=0):
     """ This function publishes a finalized image.
     
     This function calls finalize and publishes the output to a file.
@@ -385,11 +869,13 @@ def publish(image_tuple, bg_index, cover_index):
     Args:
         An image tuple with the image options, then a border image.  
         Then an index of our background followed by an index of our foreground.
+        A feather radius and the signed distances of the mask for finalize.
+        The rows per band for finalize, 0 for untiled.
 
     Returns:
         The finalized image, just in case.
     """
-    publish_image = finalize(image_tuple, bg_index, cover_index)
+    publish_image = finalize(image_tuple, bg_index, cover_index, feather, distance, band)
     
     output_name = input("What would you like to name the output file?\n")
     
@@ -424,7 +910,7 @@ def click_sub_handler(event, y, x, flags, param):
         
 
 
-def user_relay(bg_tuple, state, bg_choice, legend):
+def user_relay(bg_tuple, state, bg_choice, legend, feather=0, distance=None, band=0, measured=None):
     """ This function overlays the two images and records user input.
     
     What input is relayed varies based on the state that is passed in.
@@ -434,6 +920,9 @@ def user_relay(bg_tuple, state, bg_choice, legend):
         A state of interaction.
         An index of the background image.
         A Bool of legend on or off.
+        A feather radius and the signed distances of the mask for previews.
+        The rows per band for the overlay and finalize, 0 for untiled.
+        A dict to record the bytes the overlay or finalize allocated in.
 
     Returns:
         Returns the output from the user.
@@ -441,9 +930,11 @@ def user_relay(bg_tuple, state, bg_choice, legend):
     (gs_img, img, border_img) = bg_tuple 
     
     if state == "preview":
-        image = finalize(bg_tuple, bg_choice, ((bg_choice + 1)%2))
+        image = finalize(bg_tuple, bg_choice, ((bg_choice + 1)%2), feather, distance, band)
+        record(measured, "finalize", array_bytes(image))
     else:
-        image = overlay_mask(bg_tuple, bg_choice)
+        image = overlay_mask(bg_tuple, bg_choice, band)
+        record(measured, "overlay", array_bytes(image))
     
         
     #Display the image
@@ -465,10 +956,11 @@ def user_relay(bg_tuple, state, bg_choice, legend):
     return output
 
 
-def fill_handler(bg_tuple, bg_choice):
+def fill_handler(bg_tuple, bg_choice, labels, band, measured):
     """ This function handles the fill interaction pane of our image.
     Input   | Response:
     O       | Fill Clicked Zone (After a double click)
+    L       | Fill Clicked Segment (After a double click)
     S       | Swap Grayscale and Color Background
     G       | Swap Grayscale and Color Zones
     E       | Go to Edit State
@@ -479,6 +971,10 @@ def fill_handler(bg_tuple, bg_choice):
     Args:
         A tuple of variations of an image: a grayscale, the original,
         and an image of its borders.
+        An index of the background image.
+        A label map of segments, or None if segmentation is off.
+        The rows per band for the overlay, 0 for untiled.
+        A dict to record the bytes each stage allocated in.
 
     Returns:
         Our next state and the border image as it currently stands.
@@ -487,6 +983,7 @@ def fill_handler(bg_tuple, bg_choice):
     #This is for data validation.
     (gs_img, img, border_img) = bg_tuple
     border_img = border_img.copy() #Dereference
+    allocated = array_bytes(border_img)
     state = "fill"
     
     #Pick the background
@@ -496,6 +993,8 @@ def fill_handler(bg_tuple, bg_choice):
     legend = "FILL LEGEND:\n\n"
     legend += "Input   | Response:\n"
     legend += "O       | Fill Clicked Zone (After a double click)\n"
+    if labels is not None:
+        legend += "L       | Fill Clicked Segment (After a double click)\n"
     legend += "S       | Swap Grayscale and Color Background\n"
     legend += "G       | Swap Grayscale and Color Zones\n"
     legend += "E       | Go to Edit State\n"
@@ -504,11 +1003,19 @@ def fill_handler(bg_tuple, bg_choice):
     legend += "\n\n"
     
     #Fetch user response
-    response = user_relay(bg_tuple, state, bg_choice, legend)
+    response = user_relay(bg_tuple, state, bg_choice, legend, band=band, measured=measured)
     
     #accept a click to fill an area
     if response == ord("o"):
         border_img = fill_mask(bg_tuple[2], click_coordinates)
+        #Three copies of the mask, plus the boundary list for what changed.
+        filled = np.count_nonzero(border_img[:,:,3] != bg_tuple[2][:,:,3])
+        allocated += 3*array_bytes(border_img) + FLOOD_FILL_BYTES*filled
+    
+    #accept a click to fill a whole segment
+    elif response == ord("l") and labels is not None:
+        border_img = fill_segment(bg_tuple[2], labels, click_coordinates)
+        allocated += array_bytes(border_img)
     
     #swap the background
     elif response == ord("s"):
@@ -517,6 +1024,7 @@ def fill_handler(bg_tuple, bg_choice):
     #swap the grayscale or regular colors
     elif response == ord("g"):
         border_img = swap(border_img)
+        allocated += array_bytes(border_img)
     
     #go to the edit state
     elif response == ord("e"):
@@ -530,11 +1038,13 @@ def fill_handler(bg_tuple, bg_choice):
     elif response == ord("x"):
         state = "end"
     
+    record(measured, "handler", allocated)
+    
     return (state, border_img, bg_choice)
 
 
 
-def edit_handler(bg_tuple, bg_choice, threshold_tuple):
+def edit_handler(bg_tuple, bg_choice, threshold_tuple, band, measured):
     """ This function handles the edit interaction pane of our image.
     Input   | Response:
     D       | Dilate Border
@@ -552,6 +1062,10 @@ def edit_handler(bg_tuple, bg_choice, threshold_tuple):
     Args:
         A tuple of variations of an image: a grayscale, the original,
         and an image of its borders.
+        An index of the background image.
+        A min, max tuple of Canny thresholds.
+        The rows per band for the overlay, 0 for untiled.
+        A dict to record the bytes each stage allocated in.
 
     Returns:
         Our next state and the border image as it currently stands.
@@ -559,6 +1073,7 @@ def edit_handler(bg_tuple, bg_choice, threshold_tuple):
     #This is for data validation.
     (gs_img, img, border_img) = bg_tuple
     border_img = border_img.copy() #Dereference
+    allocated = array_bytes(border_img)
     state = "edit"
     
     #Pick the background
@@ -584,15 +1099,17 @@ def edit_handler(bg_tuple, bg_choice, threshold_tuple):
     
     
     #Fetch user input
-    response = user_relay(bg_tuple, state, bg_choice, legend)
+    response = user_relay(bg_tuple, state, bg_choice, legend, band=band, measured=measured)
     
     #dilate the border
     if response == ord("d"):
         border_img = dilate(border_img)
+        allocated += array_bytes(border_img)
  
     #bridge the border
     elif response == ord("b"):
         border_img = bridge(border_img)
+        allocated += array_bytes(border_img)
         
     #edit the canny size, then accept or reject changes
     elif response in (ord("1"), ord("2"), ord("3"), ord("4")):
@@ -605,6 +1122,7 @@ def edit_handler(bg_tuple, bg_choice, threshold_tuple):
         elif response == ord("4"):
             threshold_tuple = modify_threshold(threshold_tuple, 1, -15)
         border_img = build_mask(img, threshold_tuple)
+        record(measured, "mask", array_bytes(border_img))
         
     #swap the background
     elif response == ord("s"):
@@ -613,6 +1131,7 @@ def edit_handler(bg_tuple, bg_choice, threshold_tuple):
     #swap the grayscale or regular colors
     elif response == ord("g"):
         border_img = swap(border_img)
+        allocated += array_bytes(border_img)
     
     #return to the fill state
     elif response == ord("f"):
@@ -622,20 +1141,28 @@ def edit_handler(bg_tuple, bg_choice, threshold_tuple):
     elif response == ord("x"):
         state = "end"
     
+    record(measured, "handler", allocated)
+    
     return (state, border_img, bg_choice, threshold_tuple)
 
 
-def preview_handler(bg_tuple, bg_choice):
+def preview_handler(bg_tuple, bg_choice, feather, distance, band, measured):
     """ This function handles the preview interaction pane of our image.
     Input   | Response:
     W       | Write Image
     S       | Swap Grayscale and Color
+    1       | Increase Feather Radius by 2
+    2       | Decrease Feather Radius by 2
     F       | Return to Fill State
     X       | Exit
                 
     Args:
         A tuple of variations of an image: a grayscale, the original,
         and an image of its borders.
+        An index of the background image.
+        A feather radius and the signed distances of the mask.
+        The rows per band for finalize, 0 for untiled.
+        A dict to record the bytes each stage allocated in.
 
     Returns:
         Our next state and the border image as it currently stands.
@@ -643,6 +1170,7 @@ def preview_handler(bg_tuple, bg_choice):
     #This is for data validation.
     (gs_img, img, border_img) = bg_tuple
     border_img = border_img.copy() #Dereference
+    record(measured, "handler", array_bytes(border_img))
     state = "preview"
     
     #Pick the background.
@@ -654,21 +1182,32 @@ def preview_handler(bg_tuple, bg_choice):
     legend += "Input   | Response:\n"
     legend += "W       | Write Image\n"
     legend += "S       | Swap Grayscale and Color\n"
+    legend += "1       | Increase Feather Radius by 2\n"
+    legend += "2       | Decrease Feather Radius by 2\n"
     legend += "F       | Return to Fill State\n"
     legend += "X       | Exit\n"
-    legend += "\n\n"
+    legend += "\n"
+    legend += "Current Feather Radius:\n"
+    legend += str(feather)
+    legend += "\n\n\n"
     
     #Fetch user input.
-    response = user_relay(bg_tuple, state, bg_choice, legend)
+    response = user_relay(bg_tuple, state, bg_choice, legend, feather, distance, band, measured)
     
     #enter name and write the image to a file
     if response == ord("w"):
-        publish(bg_tuple, bg_choice, (bg_choice+1)%2)
+        publish(bg_tuple, bg_choice, (bg_choice+1)%2, feather, distance, band)
     
     #swap the grayscale or regular colors
     elif response == ord("s"):
         bg_choice = (bg_choice + 1) % 2
     
+    #widen or narrow the feathered edge
+    elif response == ord("1"):
+        feather = feather + 2
+    elif response == ord("2"):
+        feather = max(feather - 2, 0)
+    
     #return to the fill state
     elif response == ord("f"):
         state = "fill"
@@ -677,15 +1216,19 @@ def preview_handler(bg_tuple, bg_choice):
     elif response == ord("x"):
         state = "end"
     
-    return (state, border_img, bg_choice)
+    return (state, border_img, bg_choice, feather)
 
           
       
-def display_controller(image):
+def display_controller(image, use_segments=True, segment_step=20, segment_scale=1., memory_budget=None):
     """ This function controls our handlers to interact with an input image.
 
     Args:
         An image that will be handled.
+        A Bool of segmentation on or off.
+        The spacing in pixels between segment seeds.
+        A scale from 0 to 1 to shrink large images by before segmenting.
+        A memory budget in bytes, or None for no limit.
 
     Returns:
         Nothing.
@@ -695,27 +1238,89 @@ def display_controller(image):
     #Public variables
     min_threshold = 120 #Min threshold for edge detection
     max_threshold = 210 #Max threshold for edge detection
+    merge_tolerance = 12. #Max color distance for merging segments
     
     threshold_tuple = (min_threshold, max_threshold)
     
     bg_choice = 0
     
-    gs_img = grayscale(image)
-    
-    border_img = build_mask(image, threshold_tuple)
+    feather = 0 #Feather radius of the finalized edge
+    distance = None #Signed distances of the mask, for feathering
+    distance_zone = None #Fill the distances were found for
+    
+    #Where the process's peak memory stood before this run.
+    start_peak = peak_memory()
+    
+    #Plan ahead, and fall back to bands and disk if we'd go over budget.
+    (usage, projected, band, on_disk, use_segments, segment_scale) = plan_memory(image.shape, memory_budget, use_segments, segment_scale)
+    print("Projected peak memory: %.1f MB" % (projected/2.**20))
+    if on_disk:
+        print("Over budget, keeping grayscale, labels and distances on disk")
+        print("Working in bands of %d rows" % band)
+        if use_segments:
+            print("Segmenting at a scale of %.2f" % segment_scale)
+        else:
+            print("Segmentation is off")
+    if memory_budget is not None and projected > memory_budget:
+        print("Warning: projected peak is still over the %.1f MB budget" % (memory_budget/2.**20))
+    
+    #Measured bytes allocated by each stage, recorded where they run.
+    measured = {}
+    
+    gs_out = allocate(image.shape, True) if on_disk else None
+    (gs_img, seconds) = timed(grayscale, image, band, gs_out)
+    record(measured, "grayscale", array_bytes(gs_img))
+    print("Grayscale took %.3f seconds and allocated %.1f MB" % (seconds, measured["grayscale"]/2.**20))
+    
+    (border_img, seconds) = timed(build_mask, image, threshold_tuple)
+    record(measured, "mask", array_bytes(border_img))
+    print("Build mask took %.3f seconds and allocated %.1f MB" % (seconds, measured["mask"]/2.**20))
+    
+    #Precompute the segments once per image.
+    labels = None
+    if use_segments:
+        (labels, seconds) = timed(segment, image, segment_step, segment_scale, merge_tolerance)
+        record(measured, "segment", array_bytes(labels))
+        print("Segmentation took %.3f seconds and allocated %.1f MB" % (seconds, measured["segment"]/2.**20))
+        labels = stash(labels, on_disk)
     
     state = "fill" #our start state is fill.
     
     while True:
         img_tuple = (gs_img, image, border_img) #Tuple of our working images
         if state is "fill":
-            (state, border_img, bg_choice) = fill_handler(img_tuple, bg_choice)
+            (state, border_img, bg_choice) = fill_handler(img_tuple, bg_choice, labels, band, measured)
         elif state is "edit":
-            (state, border_img, bg_choice, threshold_tuple) = edit_handler(img_tuple, bg_choice, threshold_tuple)
+            (state, border_img, bg_choice, threshold_tuple) = edit_handler(img_tuple, bg_choice, threshold_tuple, band, measured)
         elif state is "preview":
-            (state, border_img, bg_choice) = preview_handler(img_tuple, bg_choice)
+            #Only redo the distance transform if the fill changed.
+            zone = border_img[:,:,2] == 255
+            if feather > 0 and not np.array_equal(zone, distance_zone):
+                (distance, seconds) = timed(mask_distance, border_img)
+                record(measured, "distance", array_bytes(distance, zone))
+                print("Distance transform took %.3f seconds and allocated %.1f MB" % (seconds, measured["distance"]/2.**20))
+                distance = stash(distance, on_disk)
+                distance_zone = zone
+            (state, border_img, bg_choice, feather) = preview_handler(img_tuple, bg_choice, feather, distance, band, measured)
         else:
             break
+    
+    #Report the memory used this run.
+    print("Memory per stage:")
+    print("%-10s| %-11s| %s" % ("Stage", "Measured", "Projected"))
+    for (stage, stage_bytes) in usage.items():
+        if stage in measured:
+            print("%-10s| %8.1f MB| %8.1f MB" % (stage, measured[stage]/2.**20, stage_bytes/2.**20))
+        else:#Stage never ran.
+            print("%-10s| %8s   | %8.1f MB" % (stage, "-", stage_bytes/2.**20))
+    print("Projected peak: %.1f MB" % (projected/2.**20))
+    
+    peak = peak_memory()
+    if peak is None:
+        print("Peak process memory isn't available on this platform.")
+    else:
+        print("Peak process memory this run: %.1f MB (%.1f MB above where it started)" %
+              (peak/2.**20, (peak - start_peak)/2.**20))
  
        
 def main():#Main
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Differential harness for the Automatic Color Splasher kernels.
+
+The loop based functions in Automatic_Color_Splasher are the golden
+references.  A faster backend is any module with functions of the same
+names and arguments.  Each kernel is run on randomized synthetic masks and
+on the bundled Images/ samples, and the pixel level diffs are reported side
+by side with the speedups.
+"""
+import gc
+import glob
+import importlib
+import os
+
+import numpy as np
+import cv2
+
+import Automatic_Color_Splasher as reference
+
+
+#Kernels that a faster backend can stand in for.
+KERNELS = ("grayscale", "build_mask", "swap", "dilate", "bridge",
+           "bgra_fill_zone", "overlay_mask", "finalize")
+
+
+def shrink(image, max_side):
+    """ This function shrinks an image so its longest side fits max_side.
+
+    The reference loops are slow, so the samples are kept small.
+
+    Args:
+        An image and the longest side it may have.
+
+    Returns:
+        The image, shrunk if it was too large.
+    """
+    scale = max_side/float(max(image.shape[0], image.shape[1]))
+    if scale < 1.:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    return image
+
+
+def random_mask(shape, rng):
+    """ This function builds a random green border with red fill mask.
+
+    Border, fill and empty pixels are scattered so every branch of the
+    mask kernels gets used.
+
+    Args:
+        The shape of the image and a numpy random generator.
+
+    Returns:
+        A 4 channel mask image.
+    """
+    mask = np.zeros((shape[0], shape[1], 4), np.uint8)
+
+    #Pick what each pixel will be.
+    roll = rng.random((shape[0], shape[1]))
+    mask[roll < 0.15] = (0, 255, 0, 255) #Green border
+    mask[(roll >= 0.15) & (roll < 0.45)] = (0, 0, 255, 100) #Red fill
+
+    return mask
+
+
+def build_cases(max_side, seeds):
+    """ This function builds the images and masks to run the kernels on.
+
+    Args:
+        The longest side for each image and the seeds for random masks.
+
+    Returns:
+        A list of tuples of a case name, a color image, and a mask.
+    """
+    cases = []
+
+    #Randomized synthetic images and masks.
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        image = rng.integers(0, 256, (max_side//2, max_side, 3), dtype=np.uint8)
+        cases.append(("random %d" % seed, image, random_mask(image.shape, rng)))
+
+    #The bundled samples with their real Canny masks.
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Images")
+    for path in sorted(glob.glob(os.path.join(folder, "*"))):
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        image = shrink(image, max_side)
+        cases.append((os.path.basename(path), image, reference.build_mask(image, (120, 210))))
+
+    return cases
+
+
+def fill_seeds(mask, rng, count):
+    """ This function picks seed pixels for the flood fill.
+
+    Seeds are drawn from empty pixels so the fill actually spreads.  If the
+    mask has no empty pixels, any pixel that isn't a border is used.
+
+    Args:
+        A mask, a numpy random generator, and how many seeds to pick.
+
+    Returns:
+        A list of (row, column) tuples.
+    """
+    (rows, cols) = np.nonzero(mask[:,:,3] == 0)
+    if rows.size == 0:
+        (rows, cols) = np.nonzero(mask[:,:,1] != 255)
+    if rows.size == 0:#Nothing but border, the fill will stop at once.
+        return [(0, 0)]
+
+    picks = rng.choice(rows.size, min(count, rows.size), replace=False)
+
+    return [(int(rows[i]), int(cols[i])) for i in picks]
+
+
+def kernel_args(name, image, mask, rng, fills):
+    """ This function builds the arguments to call a kernel with.
+
+    Args:
+        The name of a kernel, a color image, a mask, a numpy random
+        generator, and how many seeds to try for the flood fill.
+
+    Returns:
+        A list of tuples of a label for the call and its arguments.
+    """
+    if name == "grayscale":
+        args = (image,)
+    elif name == "build_mask":
+        args = (image, (120, 210))
+    elif name in ("swap", "dilate", "bridge"):
+        args = (mask,)
+    elif name == "bgra_fill_zone":
+        #Fill from several empty pixels, one call each.
+        red = np.array([0, 0, 255, 100])
+        border = np.array([0, 255, 0, 255])
+        return [("@%d,%d" % seed, (mask, seed, red, border))
+                for seed in fill_seeds(mask, rng, fills)]
+    elif name == "overlay_mask":
+        args = ((reference.grayscale(image), image, mask), 0)
+    else:
+        args = ((reference.grayscale(image), image, mask), 0, 1)
+
+    return [("", args)]
+
+
+def fresh(args):
+    """ This function copies the arrays in some arguments.
+
+    Each kernel gets its own copy so neither side can change the other's input.
+
+    Args:
+        A tuple of arguments.
+
+    Returns:
+        The same arguments with every array copied.
+    """
+    copied = []
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            arg = arg.copy()
+        elif isinstance(arg, tuple):
+            arg = fresh(arg)
+        copied.append(arg)
+
+    return tuple(copied)
+
+
+def best_times(expected_kernel, actual_kernel, args, repeats):
+    """ This function times two kernels several times and keeps the best runs.
+
+    The two kernels take turns, so a busy machine slows both alike, and the
+    garbage collector is paused while they run.
+
+    Args:
+        The reference kernel, the backend kernel, their arguments, and how
+        many times to run each.
+
+    Returns:
+        A tuple of the reference output, the backend output, and the fastest
+        reference and backend times in seconds.
+    """
+    (expected_best, actual_best) = (None, None)
+
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            (expected, seconds) = reference.timed(expected_kernel, *fresh(args))
+            if expected_best is None or seconds < expected_best:
+                expected_best = seconds
+            (actual, seconds) = reference.timed(actual_kernel, *fresh(args))
+            if actual_best is None or seconds < actual_best:
+                actual_best = seconds
+    finally:
+        gc.enable()
+
+    return (expected, actual, expected_best, actual_best)
+
+
+def compare(expected, actual):
+    """ This function compares two images pixel by pixel.
+
+    Args:
+        The reference output and the backend output.
+
+    Returns:
+        A tuple of the number of differing pixels and the largest channel
+        difference, which is None if the shapes do not match.
+    """
+    if expected.shape != actual.shape:
+        return (expected.shape[0]*expected.shape[1], None)
+
+    diff = np.abs(expected.astype(np.int32) - actual.astype(np.int32))
+    if diff.ndim == 3:
+        diff = diff.max(axis=2)
+
+    return (int((diff > 0).sum()), int(diff.max()))
+
+
+def run_harness(backend, cases, repeats, fills):
+    """ This function runs the reference and backend kernels side by side.
+
+    Args:
+        A module with faster kernels, the cases from build_cases, how many
+        times to time each call, and how many flood fill seeds per case.
+
+    Returns:
+        A list of tuples of kernel name, case name, differing pixels,
+        largest difference, and the best reference and backend seconds.
+    """
+    results = []
+
+    for name in KERNELS:
+        if not hasattr(backend, name):#Only check what the backend has.
+            continue
+        for (index, (case, image, mask)) in enumerate(cases):
+            rng = np.random.default_rng(index) #Same seeds for every backend.
+            for (label, args) in kernel_args(name, image, mask, rng, fills):
+                (expected, actual, ref_seconds, new_seconds) = best_times(
+                    getattr(reference, name), getattr(backend, name), args, repeats)
+                (pixels, largest) = compare(expected, np.asarray(actual))
+                results.append((name, case + label, pixels, largest, ref_seconds, new_seconds))
+
+    return results
+
+
+def report(results):
+    """ This function prints the diffs and speedups from run_harness.
+
+    Args:
+        The results from run_harness.
+
+    Returns:
+        The number of kernel runs whose output did not match.
+    """
+    print("%-15s| %-28s| %-8s| %-6s| %-9s| %-9s| %s" %
+          ("Kernel", "Case", "Diff px", "Max", "Ref s", "New s", "Speedup"))
+
+    mismatches = 0
+    for (name, case, pixels, largest, ref_seconds, new_seconds) in results:
+        if pixels:
+            mismatches += 1
+        largest = "shape" if largest is None else str(largest)
+        speedup = ref_seconds/max(new_seconds, 1e-9)
+        print("%-15s| %-28s| %-8d| %-6s| %-9.4f| %-9.4f| %.1fx" %
+              (name, case[:28], pixels, largest, ref_seconds, new_seconds, speedup))
+
+    if mismatches:
+        print("\n%d of %d runs did not match the reference." % (mismatches, len(results)))
+    else:
+        print("\nAll %d runs matched the reference." % len(results))
+
+    return mismatches
+
+
+def main():#Main
+    #Pick the backend to check.
+    name = input("Which module holds the faster kernels? (Blank checks the references against themselves)\n")
+    backend = importlib.import_module(name) if name else reference
+
+    cases = build_cases(160, (0, 1, 2))
+    print("Times are the best of 5 runs.\n")
+    report(run_harness(backend, cases, 5, 3))
+
+
+if __name__ == "__main__": main()